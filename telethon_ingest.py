@@ -1,18 +1,47 @@
 #!/usr/bin/env python3
 import asyncio
+import functools
+import hashlib
 import logging
 import os
+import random
 import shlex
-import sys
+import shutil
+import signal
+import sqlite3
+import time
 from pathlib import Path
 
+from botocore.exceptions import BotoCoreError, ClientError
 from dotenv import load_dotenv
-from tenacity import retry, stop_after_attempt, wait_exponential
+from s3transfer.manager import TransferManager
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from telethon import TelegramClient, events
+from telethon.errors import FloodWaitError
 from telethon.sessions import StringSession
 
+from transcode_hls import (
+    build_ffmpeg_multibitrate_cmd,
+    build_ffmpeg_remux_cmd,
+    build_ffmpeg_single_cmd,
+    can_remux,
+    clean_output_dir,
+    detect_video_encoder,
+    probe,
+    write_master_playlist,
+)
+from uploader_r2 import make_transfer_manager, upload_folder
+
 
 VIDEO_EXTS = {".mp4", ".mkv", ".mov", ".webm", ".avi", ".m4v"}
+PIPE_SAFE_EXTS = {".ts", ".webm"}
+PIPELINE_QUEUE_SIZE = 4
+PROGRESS_LOG_BYTES = 50 * 1024 * 1024
+STREAM_CHUNK_SIZE = 1024 * 1024
+FINGERPRINT_BYTES = 1024 * 1024
+SUBPROCESS_STREAM_LIMIT = 1024 * 1024
+
+logger = logging.getLogger(__name__)
 
 
 def get_env(name: str, required: bool = True, default: str | None = None) -> str | None:
@@ -27,49 +56,27 @@ def setup_logger() -> None:
     logging.basicConfig(level=getattr(logging, level, logging.INFO), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
 
-def is_video_message(msg) -> bool:
-    if not getattr(msg, "media", None):
-        return False
-    # Telethon convenience attributes
-    if getattr(msg, "video", None):
-        return True
+def classify_message(msg) -> tuple[bool, str, str]:
+    """Return (is_video, extension, video_id) from a single walk over the document attributes."""
     doc = getattr(msg, "document", None)
+    video_id = str(getattr(doc, "id", None) or f"{msg.chat_id}_{msg.id}")
+    if not getattr(msg, "media", None):
+        return False, ".mp4", video_id
+    mime = ""
+    name = None
     if doc:
         mime = getattr(doc, "mime_type", "") or ""
-        if mime.startswith("video/"):
-            return True
-        # Fallback to filename extension
-        for attr in getattr(doc, "attributes", []) or []:
-            name = getattr(attr, "file_name", None)
-            if name and Path(name).suffix.lower() in VIDEO_EXTS:
-                return True
-    return False
-
-
-def get_message_extension(msg) -> str:
-    doc = getattr(msg, "document", None)
-    if doc:
         # prefer original filename extension if present
-        for attr in getattr(doc, "attributes", []) or []:
-            name = getattr(attr, "file_name", None)
-            if name:
-                return Path(name).suffix or ".mp4"
-        mime = getattr(doc, "mime_type", "") or ""
-        if "/" in mime:
-            major, minor = mime.split("/", 1)
-            if major == "video" and minor:
-                return "." + minor
-    if getattr(msg, "video", None):
-        return ".mp4"
-    return ".mp4"
-
-
-def get_video_id(msg) -> str:
-    doc = getattr(msg, "document", None)
-    if doc and getattr(doc, "id", None):
-        return str(doc.id)
-    # fallback to chatId_messageId
-    return f"{msg.chat_id}_{msg.id}"
+        name = next((a.file_name for a in getattr(doc, "attributes", None) or () if getattr(a, "file_name", None)), None)
+    if name:
+        ext = Path(name).suffix.lower() or ".mp4"
+    elif mime.startswith("video/") and len(mime) > len("video/"):
+        ext = "." + mime.split("/", 1)[1]
+    else:
+        ext = ".mp4"
+    # Telethon's msg.video convenience attribute covers videos sent without a filename.
+    is_video = mime.startswith("video/") or bool(name and ext in VIDEO_EXTS) or bool(getattr(msg, "video", None))
+    return is_video, ext, video_id
 
 
 async def build_client() -> TelegramClient:
@@ -90,175 +97,369 @@ async def build_client() -> TelegramClient:
     return client
 
 
-def run_subprocess(cmd: list[str], cwd: Path | None = None) -> None:
+async def run_subprocess(cmd: list[str], cwd: Path | None = None, feed=None) -> None:
+    """Run cmd, logging its output; feed(stdin) is awaited alongside to stream data into the process."""
     logging.info("Running: %s", " ".join(shlex.quote(c) for c in cmd))
-    proc = asyncio.create_subprocess_exec(
+    # A larger StreamReader limit avoids many small reads on chatty ffmpeg output.
+    proc = await asyncio.create_subprocess_exec(
         *cmd,
         cwd=str(cwd) if cwd else None,
+        stdin=asyncio.subprocess.PIPE if feed else None,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.STDOUT,
+        limit=SUBPROCESS_STREAM_LIMIT,
     )
 
-    async def _drain(p):
-        assert p.stdout
-        async for line in p.stdout:
+    async def _drain():
+        assert proc.stdout
+        async for line in proc.stdout:
             logging.info(line.decode(errors="ignore").rstrip())
 
-    async def _wait(p):
-        await _drain(p)
-        rc = await p.wait()
-        if rc != 0:
-            raise RuntimeError(f"Command failed with exit code {rc}: {' '.join(cmd)}")
+    async def _feed():
+        try:
+            await feed(proc.stdin)
+        except (BrokenPipeError, ConnectionResetError):
+            # The process exited before reading everything; its exit code below is the real error.
+            logging.debug("Process closed stdin early: %s", cmd[0])
+
+    try:
+        if feed:
+            await asyncio.gather(_feed(), _drain())
+        else:
+            await _drain()
+    except BaseException:
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        raise
+    rc = await proc.wait()
+    if rc != 0:
+        raise RuntimeError(f"Command failed with exit code {rc}: {' '.join(cmd)}")
 
-    return proc, _wait
 
+def transcode_workers() -> int:
+    return max(1, int(os.getenv("TRANSCODE_WORKERS", "1")))
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=20))
-async def transcode(input_path: Path, hls_dir: Path) -> None:
+
+def transcode_threads() -> int:
+    # Share the cores between the transcodes that may run at the same time.
+    return max(1, (os.cpu_count() or 1) // transcode_workers())
+
+
+# Randomised backoff so concurrent jobs hitting the same failure don't retry in lockstep.
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    retry=retry_if_exception_type((RuntimeError, ConnectionError)),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+)
+async def transcode(input_path: Path | str, hls_dir: Path, feed=None) -> None:
     ffmpeg_bin = os.getenv("FFMPEG_PATH", "ffmpeg")
-    segment_time = os.getenv("HLS_SEGMENT_TIME", "6")
+    segment_time = int(os.getenv("HLS_SEGMENT_TIME", "6"))
     multi = os.getenv("MULTIBITRATE", "false").lower() == "true"
-    cmd = [
-        sys.executable,
-        str(Path(__file__).with_name("transcode_hls.py")),
-        str(input_path),
-        str(hls_dir),
-        "--ffmpeg",
-        ffmpeg_bin,
-        "--segment-time",
-        str(segment_time),
-    ]
+    hls_dir.mkdir(parents=True, exist_ok=True)
+    clean_output_dir(hls_dir)
     if multi:
-        cmd.append("--multi")
-    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
-    assert proc.stdout
-    async for line in proc.stdout:
-        logging.info(line.decode(errors="ignore").rstrip())
-    rc = await proc.wait()
-    if rc != 0:
-        raise RuntimeError("Transcode failed")
+        await run_subprocess(build_ffmpeg_multibitrate_cmd(input_path, hls_dir, ffmpeg_bin, segment_time, threads=transcode_threads()), feed=feed)
+        write_master_playlist(hls_dir)
+    else:
+        await run_subprocess(build_ffmpeg_single_cmd(input_path, hls_dir, ffmpeg_bin, segment_time, threads=transcode_threads()), feed=feed)
 
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=2, max=20))
-async def upload_hls(hls_dir: Path, key_prefix: str) -> None:
-    cmd = [
-        sys.executable,
-        str(Path(__file__).with_name("uploader_r2.py")),
-        "upload",
-        str(hls_dir),
-        key_prefix,
-    ]
-    proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
-    assert proc.stdout
-    async for line in proc.stdout:
-        logging.info(line.decode(errors="ignore").rstrip())
-    rc = await proc.wait()
-    if rc != 0:
-        raise RuntimeError("Upload failed")
+async def smart_transcode(input_path: Path | str, hls_dir: Path, feed=None, head: bytes | None = None) -> None:
+    """Remux already-compatible H.264 straight into HLS; re-encode everything else.
 
+    For piped input (input_path "pipe:0" with a feed), head holds the leading bytes used for probing.
+    """
+    multi = os.getenv("MULTIBITRATE", "false").lower() == "true"
+    # Multi-bitrate still needs the lower renditions, so only single-rendition output can skip the encode.
+    if not multi:
+        try:
+            info = await asyncio.to_thread(probe, input_path, os.getenv("FFPROBE_PATH", "ffprobe"), head)
+            if can_remux(info):
+                ffmpeg_bin = os.getenv("FFMPEG_PATH", "ffmpeg")
+                segment_time = int(os.getenv("HLS_SEGMENT_TIME", "6"))
+                hls_dir.mkdir(parents=True, exist_ok=True)
+                clean_output_dir(hls_dir)
+                logging.info("Input is HLS-compatible H.264; remuxing without re-encode")
+                await run_subprocess(build_ffmpeg_remux_cmd(input_path, hls_dir, ffmpeg_bin, segment_time, info), feed=feed)
+                return
+        except FloodWaitError:
+            raise
+        except Exception as e:
+            logging.warning("Remux path failed (%s); falling back to full transcode", e)
+    await transcode(input_path, hls_dir, feed=feed)
+
+
+@retry(
+    stop=stop_after_attempt(5),
+    wait=wait_random_exponential(multiplier=1, max=30),
+    retry=retry_if_exception_type((RuntimeError, ConnectionError, BotoCoreError, ClientError)),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+)
+async def upload_hls(hls_dir: Path, key_prefix: str, manager: TransferManager | None = None) -> None:
+    bucket = get_env("R2_BUCKET")
+    # boto3 is blocking; keep it off the event loop.
+    await asyncio.to_thread(upload_folder, hls_dir, key_prefix, bucket, manager=manager)
+
+
+def can_stream_transcode(msg, ext: str) -> bool:
+    """Whether the media can be piped straight into ffmpeg without a seekable file."""
+    if os.getenv("STREAM_TRANSCODE", "true").lower() != "true":
+        return False
+    if ext.lower() in PIPE_SAFE_EXTS:
+        return True
+    # mp4/mov need the moov atom up front; Telegram marks such uploads as streamable.
+    doc = getattr(msg, "document", None)
+    attrs = getattr(doc, "attributes", None) or []
+    return ext.lower() in {".mp4", ".m4v"} and any(getattr(a, "supports_streaming", False) for a in attrs)
 
-async def handle_message(client: TelegramClient, event):
-    msg = event.message
-    if not is_video_message(msg):
-        return
-    video_id = get_video_id(msg)
-    workdir = Path(os.getenv("WORKDIR", "./workdir")) / video_id
-    hls_dir = workdir / "hls"
-    workdir.mkdir(parents=True, exist_ok=True)
 
-    ext = get_message_extension(msg)
-    input_path = workdir / f"input{ext}"
-    logging.info("Downloading media to %s", input_path)
+def _fingerprint(head: bytes, tail: bytes, size: int) -> str:
+    h = hashlib.sha256()
+    h.update(head)
+    h.update(tail)
+    h.update(str(size).encode())
+    return h.hexdigest()
+
+
+def fingerprint_file(path: Path) -> str:
+    """Content fingerprint from the first and last MB plus the size; cheap even for multi-GB files."""
+    size = path.stat().st_size
+    with path.open("rb") as f:
+        head = f.read(FINGERPRINT_BYTES)
+        f.seek(max(0, size - FINGERPRINT_BYTES))
+        tail = f.read()
+    return _fingerprint(head, tail, size)
+
+
+class PublishedIndex:
+    """SQLite map of content fingerprint -> video_id already published to R2."""
+
+    def __init__(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS published (digest TEXT PRIMARY KEY, video_id TEXT NOT NULL)")
+        self.conn.commit()
+
+    def get(self, digest: str) -> str | None:
+        row = self.conn.execute("SELECT video_id FROM published WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, digest: str, video_id: str) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO published (digest, video_id) VALUES (?, ?)", (digest, video_id))
+        self.conn.commit()
+
+
+def telegram_feed(client: TelegramClient, msg):
+    async def _feed(stdin: asyncio.StreamWriter) -> None:
+        try:
+            async for chunk in client.iter_download(msg.media, chunk_size=STREAM_CHUNK_SIZE):
+                stdin.write(chunk)
+                await stdin.drain()
+        finally:
+            stdin.close()
+    return _feed
+
+
+async def read_remote_chunk(client: TelegramClient, msg, offset: int) -> bytes:
+    """Fetch up to FINGERPRINT_BYTES of the message's media starting at offset."""
+    data = bytearray()
+    async for chunk in client.iter_download(msg.media, offset=offset, limit=1, chunk_size=FINGERPRINT_BYTES, file_size=msg.document.size):
+        data += chunk
+    return bytes(data[:FINGERPRINT_BYTES])
+
+
+async def fingerprint_remote(client: TelegramClient, msg, head: bytes) -> str:
+    """Same digest as fingerprint_file, fetching only the last MB from Telegram."""
+    size = msg.document.size
+    tail = await read_remote_chunk(client, msg, max(0, size - FINGERPRINT_BYTES))
+    return _fingerprint(head, tail, size)
+
+
+def public_url(video_id: str) -> str:
+    base = get_env("WORKER_PUBLIC_BASE_URL")
+    return f"{base.rstrip('/')}/videos/{video_id}/playlist.m3u8"
+
+
+async def with_flood_wait(factory):
+    """Await factory(), sleeping out Telegram flood waits (plus jitter) instead of spending retry attempts."""
+    while True:
+        try:
+            return await factory()
+        except FloodWaitError as e:
+            delay = e.seconds + random.uniform(0, 2)
+            logging.warning("Telegram flood wait: sleeping %.1fs", delay)
+            await asyncio.sleep(delay)
+
+
+async def notify(client: TelegramClient, chat_id, text: str) -> None:
     try:
-        await client.send_message(entity=msg.chat_id, message=f"⏳ Received video {video_id}. Downloading…")
+        await client.send_message(entity=chat_id, message=text)
     except Exception:
         pass
-    _last_progress = {"t": None, "r": 0}
+
+
+async def handle_message(client: TelegramClient, event, download_q: asyncio.Queue) -> None:
+    msg = event.message
+    is_video, ext, video_id = classify_message(msg)
+    if not is_video:
+        return
+    workdir = Path(os.getenv("WORKDIR", "./workdir")) / video_id
+    job = {
+        "msg": msg,
+        "chat_id": msg.chat_id,
+        "video_id": video_id,
+        "workdir": workdir,
+        "input_path": workdir / f"input{ext}",
+        "hls_dir": workdir / "hls",
+        "stream": can_stream_transcode(msg, ext),
+    }
+    await notify(client, msg.chat_id, f"⏳ Received video {video_id}. Downloading…")
+    await download_q.put(job)
+
+
+async def download_stage(client: TelegramClient, job: dict) -> None:
+    msg = job["msg"]
+    input_path = job["input_path"]
+    job["workdir"].mkdir(parents=True, exist_ok=True)
+    if job["stream"]:
+        # Downloaded by the transcode stage straight into ffmpeg's stdin.
+        return
+    logging.info("Downloading media to %s", input_path)
+    # [next log threshold, last logged time, last logged bytes]; the hot path is a single comparison.
+    state = [0, None, 0]
     def _progress(received: int, total: int):
-        try:
-            import time
-            now = time.time()
-            pct = (received / total * 100) if total else 0
-            # log every ~50MB or at start/end
-            if (received == 0 or received == total or received - _last_progress["r"] >= 50 * 1024 * 1024):
-                mb = received/1024/1024
-                totmb = (total or 0)/1024/1024
-                rate = ""
-                if _last_progress["t"]:
-                    dt = max(now - _last_progress["t"], 1e-6)
-                    dr = received - _last_progress["r"]
-                    mbs = (dr/1024/1024)/dt
-                    rate = f" @ {mbs:.2f} MB/s"
-                logging.info("Downloading… %.1fMB / %.1fMB (%.1f%%)%s", mb, totmb, pct, rate)
-                _last_progress["t"] = now
-                _last_progress["r"] = received
-        except Exception:
-            pass
+        if received < state[0] and received != total:
+            return
+        now = time.monotonic()
+        rate = ""
+        if state[1] is not None:
+            mbs = (received - state[2]) / 1024 / 1024 / max(now - state[1], 1e-6)
+            rate = f" @ {mbs:.2f} MB/s"
+        pct = (received / total * 100) if total else 0
+        logging.info("Downloading… %.1fMB / %.1fMB (%.1f%%)%s", received / 1024 / 1024, (total or 0) / 1024 / 1024, pct, rate)
+        state[0] = received + PROGRESS_LOG_BYTES
+        state[1] = now
+        state[2] = received
+
+    part_kb = int(os.getenv("TELETHON_PART_SIZE_KB", "2048"))
+    # Prefer download_file for tuning part size; falls back to download_media.
+    media = getattr(msg, "media", None)
+    if media is not None:
+        await with_flood_wait(lambda: client.download_file(media, file=str(input_path), part_size_kb=part_kb, progress_callback=_progress))
+    else:
+        await with_flood_wait(lambda: client.download_media(msg, file=str(input_path), progress_callback=_progress))
 
-    try:
-        part_kb = int(os.getenv("TELETHON_PART_SIZE_KB", "2048"))
-        # Prefer download_file for tuning part size; falls back to download_media.
-        media = getattr(msg, "media", None)
-        if media is not None:
-            await client.download_file(media, file=str(input_path), part_size_kb=part_kb, progress_callback=_progress)
+
+async def transcode_stage(client: TelegramClient, job: dict, index: PublishedIndex | None = None) -> None:
+    msg = job["msg"]
+    multi = os.getenv("MULTIBITRATE", "false").lower() == "true"
+    # Streamed jobs fetch the first MB up front, but only if it will be fingerprinted or probed for a remux.
+    head = None
+    if job["stream"] and (index or not multi):
+        head = await with_flood_wait(lambda: read_remote_chunk(client, msg, 0))
+    if index:
+        if job["stream"]:
+            # Only the first and last MB are fetched, so duplicates are caught before any streaming starts.
+            job["digest"] = await with_flood_wait(lambda: fingerprint_remote(client, msg, head))
         else:
-            await client.download_media(msg, file=str(input_path), progress_callback=_progress)
-    except Exception as e:
-        logging.exception("Download failed: %s", e)
-        return
+            job["digest"] = await asyncio.to_thread(fingerprint_file, job["input_path"])
+        existing = index.get(job["digest"])
+        if existing:
+            logging.info("Video %s matches already published %s; skipping transcode", job["video_id"], existing)
+            job["existing_id"] = existing
+            return
+    await notify(client, job["chat_id"], f"🎬 Transcoding {job['video_id']} to HLS…")
+    if job["stream"]:
+        logging.info("Streaming %s from Telegram into ffmpeg", job["video_id"])
+        await with_flood_wait(lambda: smart_transcode("pipe:0", job["hls_dir"], feed=telegram_feed(client, msg), head=head))
+    else:
+        await smart_transcode(job["input_path"], job["hls_dir"])
 
-    try:
-        try:
-            await client.send_message(entity=msg.chat_id, message=f"🎬 Transcoding {video_id} to HLS…")
-        except Exception:
-            pass
-        await transcode(input_path, hls_dir)
-        try:
-            await client.send_message(entity=msg.chat_id, message=f"📤 Uploading {video_id} to R2…")
-        except Exception:
-            pass
+
+async def upload_stage(client: TelegramClient, job: dict, manager: TransferManager | None = None, index: PublishedIndex | None = None) -> None:
+    video_id = job["video_id"]
+    # An identical video may have finished publishing while this one was transcoding.
+    if index and job.get("digest") and not job.get("existing_id"):
+        job["existing_id"] = index.get(job["digest"])
+    if job.get("existing_id"):
+        # The link is the whole point of the job, so wait out flood limits rather than drop it.
+        await with_flood_wait(lambda: client.send_message(entity=job["chat_id"], message=f"✅ Ready: {public_url(job['existing_id'])}"))
+    else:
+        await notify(client, job["chat_id"], f"📤 Uploading {video_id} to R2…")
         root = os.getenv("R2_KEY_ROOT", "videos").strip("/") or "videos"
         key_prefix = f"{root}/{video_id}"
-        await upload_hls(hls_dir, key_prefix)
-        base = get_env("WORKER_PUBLIC_BASE_URL")
-        public_url = f"{base.rstrip('/')}/videos/{video_id}/playlist.m3u8"
-        await client.send_message(entity=msg.chat_id, message=f"✅ Ready: {public_url}")
-        if os.getenv("CLEANUP", "false").lower() == "true":
-            try:
-                for p in workdir.rglob("*"):
-                    if p.is_file():
-                        p.unlink(missing_ok=True)
-                for p in sorted(workdir.glob("**/*"), reverse=True):
-                    if p.is_dir():
-                        p.rmdir()
-            except Exception as ce:
-                logging.warning("Cleanup failed: %s", ce)
-    except Exception as e:
-        logging.exception("Processing failed: %s", e)
-        await client.send_message(entity=msg.chat_id, message=f"❌ Failed to process video: {e}")
-
-
-async def main_async() -> None:
-    load_dotenv()
-    setup_logger()
-    client = await build_client()
-    # Preflight: ensure R2 and worker envs are present to avoid late-stage failures.
-    missing = []
-    for name in [
-        "R2_ACCOUNT_ID",
-        "R2_ACCESS_KEY_ID",
-        "R2_SECRET_ACCESS_KEY",
-        "R2_BUCKET",
-        "WORKER_PUBLIC_BASE_URL",
-    ]:
-        if not os.getenv(name):
-            missing.append(name)
-    if missing:
-        logging.error(
-            "Missing required env vars: %s. Please set them in your .env or container environment.",
-            ", ".join(missing),
-        )
-        raise RuntimeError("Missing required environment variables: " + ", ".join(missing))
+        await upload_hls(job["hls_dir"], key_prefix, manager=manager)
+        if index and job.get("digest"):
+            index.put(job["digest"], video_id)
+        await with_flood_wait(lambda: client.send_message(entity=job["chat_id"], message=f"✅ Ready: {public_url(video_id)}"))
+    if os.getenv("CLEANUP", "false").lower() == "true":
+        shutil.rmtree(job["workdir"], ignore_errors=True)
+
+
+async def stage_worker(name: str, client: TelegramClient, stage, in_q: asyncio.Queue, out_q: asyncio.Queue | None = None) -> None:
+    """Consume jobs from in_q, run one pipeline stage, and hand successful jobs to out_q."""
+    while True:
+        job = await in_q.get()
+        try:
+            await stage(client, job)
+            if out_q is not None:
+                await out_q.put(job)
+        except asyncio.CancelledError:
+            # Shutdown mid-stage: run_subprocess has already killed ffmpeg, so drop the partial output.
+            shutil.rmtree(job["workdir"], ignore_errors=True)
+            raise
+        except Exception as e:
+            logging.exception("%s failed for %s: %s", name, job["video_id"], e)
+            await notify(client, job["chat_id"], f"❌ Failed to process video: {e}")
+        finally:
+            in_q.task_done()
+
+
+def start_pipeline(
+    client: TelegramClient, tg: asyncio.TaskGroup, download_q: asyncio.Queue
+) -> tuple[list[asyncio.Queue], list[asyncio.Task], TransferManager]:
+    # Separate queues per stage so message B downloads while A transcodes and an earlier one uploads.
+    transcode_q: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    upload_q: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    # One client and transfer manager for all upload workers, so total concurrency matches the connection pool.
+    manager = make_transfer_manager()
+    index = None
+    if os.getenv("DEDUP", "true").lower() == "true":
+        index = PublishedIndex(Path(os.getenv("DEDUP_DB", str(Path(os.getenv("WORKDIR", "./workdir")) / "published.sqlite3"))))
+    stages = [
+        ("download", download_stage, download_q, transcode_q, int(os.getenv("DOWNLOAD_WORKERS", "2"))),
+        ("transcode", functools.partial(transcode_stage, index=index), transcode_q, upload_q, transcode_workers()),
+        ("upload", functools.partial(upload_stage, manager=manager, index=index), upload_q, None, int(os.getenv("UPLOAD_WORKERS", "3"))),
+    ]
+    tasks = []
+    for name, stage, in_q, out_q, count in stages:
+        for i in range(max(1, count)):
+            tasks.append(tg.create_task(stage_worker(name, client, stage, in_q, out_q), name=f"{name}-{i}"))
+    return [download_q, transcode_q, upload_q], tasks, manager
+
+
+async def shutdown_pipeline(
+    client: TelegramClient, workers: list[asyncio.Task], queues: list[asyncio.Queue], manager: TransferManager | None = None
+) -> None:
+    """Cancel stage workers, drop the workdirs of jobs still queued, then disconnect so main_async can exit."""
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    for q in queues:
+        while not q.empty():
+            job = q.get_nowait()
+            shutil.rmtree(job["workdir"], ignore_errors=True)
+            q.task_done()
+    if manager is not None:
+        # Workers are gone, so nothing is waiting on its transfers any more.
+        await asyncio.to_thread(manager.shutdown, cancel=True)
+    if client.is_connected():
+        await client.disconnect()
+
+
+async def register_handlers(client: TelegramClient, download_q: asyncio.Queue) -> None:
     # Watching source can be optional: for bot accounts, watch all incoming messages.
     source = os.getenv("TELEGRAM_WATCH_SOURCE")
     me = await client.get_me()
@@ -272,19 +473,19 @@ async def main_async() -> None:
                 @client.on(events.NewMessage(chats=entity))
                 async def _(event):
                     logging.debug("Incoming message: chat=%s id=%s", event.chat_id, event.id)
-                    await handle_message(client, event)
+                    await handle_message(client, event, download_q)
             except Exception as e:
                 logging.warning("Failed to resolve entity '%s' (%s). Falling back to all incoming messages.", source, e)
                 @client.on(events.NewMessage(incoming=True))
                 async def _(event):
                     logging.debug("Incoming message: chat=%s id=%s", event.chat_id, event.id)
-                    await handle_message(client, event)
+                    await handle_message(client, event, download_q)
         else:
             logging.info("Bot mode: watching all incoming messages")
             @client.on(events.NewMessage(incoming=True))
             async def _(event):
                 logging.debug("Incoming message: chat=%s id=%s", event.chat_id, event.id)
-                await handle_message(client, event)
+                await handle_message(client, event, download_q)
     else:
         # User accounts typically watch a specific chat or channel.
         if not source:
@@ -294,13 +495,54 @@ async def main_async() -> None:
         @client.on(events.NewMessage(chats=entity))
         async def _(event):
             logging.debug("Incoming message: chat=%s id=%s", event.chat_id, event.id)
-            await handle_message(client, event)
+            await handle_message(client, event, download_q)
 
     # Also process existing media if desired (optional; uncomment)
     # async for m in client.iter_messages(entity, limit=10):
-    #     await handle_message(client, type("E", (), {"message": m}))
+    #     await handle_message(client, type("E", (), {"message": m}), download_q)
 
-    await client.run_until_disconnected()
+
+async def main_async() -> None:
+    load_dotenv()
+    setup_logger()
+    client = await build_client()
+    # Preflight: ensure R2 and worker envs are present to avoid late-stage failures.
+    missing = []
+    for name in [
+        "R2_ACCOUNT_ID",
+        "R2_ACCESS_KEY_ID",
+        "R2_SECRET_ACCESS_KEY",
+        "R2_BUCKET",
+        "WORKER_PUBLIC_BASE_URL",
+    ]:
+        if not os.getenv(name):
+            missing.append(name)
+    if missing:
+        logging.error(
+            "Missing required env vars: %s. Please set them in your .env or container environment.",
+            ", ".join(missing),
+        )
+        raise RuntimeError("Missing required environment variables: " + ", ".join(missing))
+    # Probe hardware encoders once up-front so the first transcode doesn't block the loop on it.
+    await asyncio.to_thread(detect_video_encoder, os.getenv("FFMPEG_PATH", "ffmpeg"))
+    # Handlers only enqueue, so register them (and surface config errors plainly) before any worker starts.
+    download_q: asyncio.Queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    await register_handlers(client, download_q)
+    # Workers live in a TaskGroup so shutdown waits for them (and their ffmpeg children) to finish cleaning up.
+    async with asyncio.TaskGroup() as tg:
+        queues, workers, manager = start_pipeline(client, tg, download_q)
+        shutdown_tasks = []
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, lambda: shutdown_tasks.append(asyncio.create_task(shutdown_pipeline(client, workers, queues, manager))))
+            except NotImplementedError:
+                # Not supported on Windows event loops; KeyboardInterrupt still ends the process.
+                pass
+        try:
+            await client.run_until_disconnected()
+        finally:
+            await shutdown_pipeline(client, workers, queues, manager)
 
 
 def main() -> None:
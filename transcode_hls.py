@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 import argparse
+import functools
+import json
 import logging
 import os
 import shutil
@@ -15,43 +17,137 @@ def setup_logger(level: str = "INFO") -> None:
     )
 
 
-def run_ffmpeg_single(input_path: Path, output_dir: Path, ffmpeg_bin: str, segment_time: int) -> None:
+# Fixed parts of the ffmpeg argv; only paths, encoder and thread counts vary per call.
+_GLOBAL_ARGS = ("-hide_banner", "-y")
+# temp_file writes each segment under a temporary name and renames it once complete.
+_HLS_FLAGS = "temp_file+independent_segments+program_date_time"
+_SINGLE_CMD_TEMPLATE = (
+    "-map", "0:v:0",
+    "-map", "0:a:0?",
+    "-g", "48",
+    "-keyint_min", "48",
+    "-c:a", "aac",
+    "-b:a", "128k",
+    "-hls_playlist_type", "vod",
+    "-hls_flags", _HLS_FLAGS,
+)
+_RENDITION_CMD_TEMPLATE = (
+    "-map", "0:a:0?",
+    "-g", "48",
+    "-keyint_min", "48",
+    "-c:a", "aac",
+    "-bufsize", "2M",
+    "-hls_playlist_type", "vod",
+    "-hls_flags", _HLS_FLAGS,
+)
+_REMUX_CMD_TEMPLATE = (
+    "-map", "0:v:0",
+    "-map", "0:a:0?",
+    "-c:v", "copy",
+    "-hls_playlist_type", "vod",
+    "-hls_flags", _HLS_FLAGS,
+)
+RENDITIONS = (
+    {"name": "720p", "scale": "-2:720", "v_bitrate": "3000k", "a_bitrate": "128k"},
+    {"name": "480p", "scale": "-2:480", "v_bitrate": "1500k", "a_bitrate": "96k"},
+)
+
+HW_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_videotoolbox")
+
+
+def video_encoder_args(encoder: str) -> list[str]:
+    if encoder == "h264_nvenc":
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-tune", "hq", "-rc", "vbr", "-cq", "23", "-b:v", "0"]
+    if encoder == "h264_qsv":
+        return ["-c:v", "h264_qsv", "-preset", "veryfast", "-global_quality", "23"]
+    if encoder == "h264_videotoolbox":
+        return ["-c:v", "h264_videotoolbox", "-q:v", "65"]
+    return ["-c:v", "libx264", "-preset", "veryfast", "-crf", "23", "-x264-params", "aq-mode=3"]
+
+
+@functools.lru_cache(maxsize=None)
+def detect_video_encoder(ffmpeg_bin: str) -> str:
+    """Pick a working hardware H.264 encoder, falling back to libx264.
+
+    FFMPEG_HWACCEL selects the mode: auto (default), none, or one of nvenc/qsv/videotoolbox.
+    """
+    mode = os.getenv("FFMPEG_HWACCEL", "auto").lower()
+    if mode in ("none", "off", "false", "libx264"):
+        return "libx264"
+    candidates = HW_ENCODERS if mode == "auto" else tuple(e for e in HW_ENCODERS if mode in e)
+    try:
+        listed = subprocess.run([ffmpeg_bin, "-hide_banner", "-encoders"], capture_output=True, text=True, timeout=30).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.warning("Could not list ffmpeg encoders (%s); using libx264", e)
+        return "libx264"
+    for enc in candidates:
+        if enc not in listed:
+            continue
+        # Distro builds list hardware encoders even without the device, so try a tiny encode.
+        probe = [ffmpeg_bin, "-hide_banner", "-v", "error", "-f", "lavfi", "-i", "color=size=256x144:duration=0.2", *video_encoder_args(enc), "-f", "null", "-"]
+        try:
+            ok = subprocess.run(probe, capture_output=True, timeout=30).returncode == 0
+        except (OSError, subprocess.SubprocessError):
+            ok = False
+        if ok:
+            logging.info("Using hardware encoder %s", enc)
+            return enc
+    logging.info("No usable hardware encoder found; using libx264")
+    return "libx264"
+
+
+def hw_decode_args(encoder: str) -> list[str]:
+    # Keep decode and scaling on the GPU with NVENC; opt-in because not every input codec decodes under CUDA.
+    if encoder == "h264_nvenc" and os.getenv("FFMPEG_HWDECODE", "false").lower() == "true":
+        return ["-hwaccel", "cuda", "-hwaccel_output_format", "cuda"]
+    return []
+
+
+def keyframe_args(segment_time: int) -> list[str]:
+    # Force an IDR at every segment boundary so segments cut exactly and decode independently.
+    return ["-force_key_frames", f"expr:gte(t,n_forced*{segment_time})"]
+
+
+def thread_args(threads: int | None) -> list[str]:
+    # Explicit per-encoder threads keep concurrent transcodes from oversubscribing cores.
+    return ["-threads", str(threads)] if threads else []
+
+
+def scale_filter(encoder: str, scale: str) -> str:
+    if hw_decode_args(encoder):
+        return f"scale_cuda={scale}"
+    return f"scale={scale}:flags=lanczos"
+
+
+def build_ffmpeg_single_cmd(
+    input_path: Path | str, output_dir: Path, ffmpeg_bin: str, segment_time: int, encoder: str | None = None, threads: int | None = None
+) -> list[str]:
+    encoder = encoder or detect_video_encoder(ffmpeg_bin)
     playlist = output_dir / "playlist.m3u8"
     segment_pattern = str((output_dir / "seg_%05d.ts").resolve())
-    cmd = [
+    return [
         ffmpeg_bin,
-        "-hide_banner",
-        "-y",
+        *_GLOBAL_ARGS,
+        *hw_decode_args(encoder),
         "-i",
         str(input_path),
-        "-map",
-        "0:v:0",
-        "-map",
-        "0:a:0?",
-        "-c:v",
-        "libx264",
-        "-preset",
-        "veryfast",
-        "-crf",
-        "23",
-        "-g",
-        "48",
-        "-sc_threshold",
-        "0",
-        "-c:a",
-        "aac",
-        "-b:a",
-        "128k",
+        *_SINGLE_CMD_TEMPLATE,
+        *video_encoder_args(encoder),
+        *thread_args(threads),
+        *keyframe_args(segment_time),
         "-vf",
-        "scale=-2:720:flags=lanczos",
+        scale_filter(encoder, "-2:720"),
         "-hls_time",
         str(segment_time),
-        "-hls_playlist_type",
-        "vod",
         "-hls_segment_filename",
         segment_pattern,
         str(playlist),
     ]
+
+
+def run_ffmpeg_single(input_path: Path, output_dir: Path, ffmpeg_bin: str, segment_time: int, threads: int | None = None) -> None:
+    playlist = output_dir / "playlist.m3u8"
+    cmd = build_ffmpeg_single_cmd(input_path, output_dir, ffmpeg_bin, segment_time, threads=threads)
     logging.info("Running ffmpeg: %s", " ".join(cmd))
     proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
     if proc.returncode != 0:
@@ -61,62 +157,115 @@ def run_ffmpeg_single(input_path: Path, output_dir: Path, ffmpeg_bin: str, segme
         logging.info("ffmpeg completed successfully. Output at %s", playlist)
 
 
-def run_ffmpeg_multibitrate(input_path: Path, output_dir: Path, ffmpeg_bin: str, segment_time: int) -> None:
+def build_ffmpeg_multibitrate_cmd(
+    input_path: Path | str, output_dir: Path, ffmpeg_bin: str, segment_time: int, encoder: str | None = None, threads: int | None = None
+) -> list[str]:
+    encoder = encoder or detect_video_encoder(ffmpeg_bin)
     # 720p and 480p renditions, separate playlists, and a master playlist.
     var_dir = output_dir / "variants"
     var_dir.mkdir(parents=True, exist_ok=True)
-    renditions = [
-        {"name": "720p", "scale": "-2:720", "v_bitrate": "3000k", "a_bitrate": "128k"},
-        {"name": "480p", "scale": "-2:480", "v_bitrate": "1500k", "a_bitrate": "96k"},
+    # Decode once and fan out to every rendition via split; each output group gets its own encoder.
+    labels = [f"v{r['name']}" for r in RENDITIONS]
+    # Both encoders run at once, so split the thread budget between them.
+    per_output_threads = max(1, threads // len(RENDITIONS)) if threads else None
+    filter_complex = f"[0:v:0]split={len(RENDITIONS)}" + "".join(f"[s{i}]" for i in range(len(RENDITIONS))) + ";" + ";".join(
+        f"[s{i}]{scale_filter(encoder, r['scale'])}[{label}]" for i, (r, label) in enumerate(zip(RENDITIONS, labels))
+    )
+    cmd = [
+        ffmpeg_bin,
+        *_GLOBAL_ARGS,
+        *hw_decode_args(encoder),
+        "-i",
+        str(input_path),
+        "-filter_complex",
+        filter_complex,
     ]
-    for r in renditions:
+    for r, label in zip(RENDITIONS, labels):
         playlist = var_dir / f"{r['name']}.m3u8"
         segment_pattern = str((var_dir / f"seg_{r['name']}_%05d.ts").resolve())
-        cmd = [
-            ffmpeg_bin,
-            "-hide_banner",
-            "-y",
-            "-i",
-            str(input_path),
+        cmd += [
             "-map",
-            "0:v:0",
-            "-map",
-            "0:a:0?",
-            "-c:v",
-            "libx264",
-            "-preset",
-            "veryfast",
-            "-crf",
-            "23",
-            "-g",
-            "48",
-            "-sc_threshold",
-            "0",
-            "-c:a",
-            "aac",
+            f"[{label}]",
+            *_RENDITION_CMD_TEMPLATE,
             "-b:a",
             r["a_bitrate"],
-            "-vf",
-            f"scale={r['scale']}:flags=lanczos",
             "-maxrate",
             r["v_bitrate"],
-            "-bufsize",
-            "2M",
+            *video_encoder_args(encoder),
+            *thread_args(per_output_threads),
+            *keyframe_args(segment_time),
             "-hls_time",
             str(segment_time),
-            "-hls_playlist_type",
-            "vod",
             "-hls_segment_filename",
             segment_pattern,
             str(playlist),
         ]
-        logging.info("Running ffmpeg (rendition %s): %s", r['name'], " ".join(cmd))
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-        if proc.returncode != 0:
-            logging.error("ffmpeg failed for %s with output:\n%s", r['name'], proc.stdout)
-            raise SystemExit(proc.returncode)
+    return cmd
+
+
+def probe(input_path: Path | str, ffprobe_bin: str = "ffprobe", data: bytes | None = None) -> dict:
+    """Probe the first video/audio streams; with data, those leading bytes are probed via stdin instead."""
+    cmd = [
+        ffprobe_bin,
+        "-v",
+        "error",
+        "-show_entries",
+        "stream=codec_type,codec_name,width,height,pix_fmt:stream_tags=rotate:stream_side_data=rotation",
+        "-of",
+        "json",
+        "pipe:0" if data is not None else str(input_path),
+    ]
+    proc = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {proc.stderr.decode(errors='ignore').strip()}")
+    streams = json.loads(proc.stdout).get("streams", [])
+    video = next((st for st in streams if st.get("codec_type") == "video"), None)
+    audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+    return {"video": video, "audio": audio}
+
+
+def rotation(video: dict) -> int:
+    # Older ffmpeg reports a rotate tag; newer ones a display matrix in side data.
+    rotate = (video.get("tags") or {}).get("rotate")
+    if rotate is None:
+        rotate = next((sd["rotation"] for sd in video.get("side_data_list") or [] if "rotation" in sd), 0)
+    return int(float(rotate or 0))
+
+
+def can_remux(info: dict, max_height: int = 720) -> bool:
+    """True when the video stream is already HLS-friendly H.264 and can be copied as-is."""
+    video = info.get("video") or {}
+    return (
+        video.get("codec_name") == "h264"
+        and video.get("pix_fmt") in ("yuv420p", "yuvj420p")
+        and 0 < int(video.get("height") or 0) <= max_height
+        # MPEG-TS has no display matrix, so a copied rotated clip would play sideways.
+        and rotation(video) % 360 == 0
+    )
+
+
+def build_ffmpeg_remux_cmd(input_path: Path | str, output_dir: Path, ffmpeg_bin: str, segment_time: int, info: dict) -> list[str]:
+    playlist = output_dir / "playlist.m3u8"
+    segment_pattern = str((output_dir / "seg_%05d.ts").resolve())
+    # Copy audio too when it is already something every HLS player handles.
+    audio = info.get("audio") or {}
+    audio_args = ["-c:a", "copy"] if audio.get("codec_name") in ("aac", "mp3") else ["-c:a", "aac", "-b:a", "128k"]
+    return [
+        ffmpeg_bin,
+        *_GLOBAL_ARGS,
+        "-i",
+        str(input_path),
+        *_REMUX_CMD_TEMPLATE,
+        *audio_args,
+        "-hls_time",
+        str(segment_time),
+        "-hls_segment_filename",
+        segment_pattern,
+        str(playlist),
+    ]
 
-    # Write master playlist
+
+def write_master_playlist(output_dir: Path) -> None:
     master = output_dir / "playlist.m3u8"
     with master.open("w", encoding="utf-8") as f:
         f.write("#EXTM3U\n")
@@ -129,6 +278,16 @@ def run_ffmpeg_multibitrate(input_path: Path, output_dir: Path, ffmpeg_bin: str,
     logging.info("Master playlist generated at %s", master)
 
 
+def run_ffmpeg_multibitrate(input_path: Path, output_dir: Path, ffmpeg_bin: str, segment_time: int, threads: int | None = None) -> None:
+    cmd = build_ffmpeg_multibitrate_cmd(input_path, output_dir, ffmpeg_bin, segment_time, threads=threads)
+    logging.info("Running ffmpeg (multi-bitrate): %s", " ".join(cmd))
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if proc.returncode != 0:
+        logging.error("ffmpeg failed with output:\n%s", proc.stdout)
+        raise SystemExit(proc.returncode)
+    write_master_playlist(output_dir)
+
+
 def clean_output_dir(output_dir: Path) -> None:
     if output_dir.exists():
         for p in output_dir.glob("*"):
@@ -145,6 +304,7 @@ def main() -> None:
     parser.add_argument("--ffmpeg", dest="ffmpeg_bin", default=os.getenv("FFMPEG_PATH", "ffmpeg"), help="ffmpeg binary path")
     parser.add_argument("--segment-time", dest="segment_time", type=int, default=int(os.getenv("HLS_SEGMENT_TIME", "6")), help="HLS segment duration seconds")
     parser.add_argument("--multi", dest="multi", action="store_true", help="Enable multi-bitrate (720p+480p) with master playlist")
+    parser.add_argument("--threads", dest="threads", type=int, default=None, help="Encoder threads (default: ffmpeg decides)")
     parser.add_argument("--log-level", dest="log_level", default=os.getenv("LOG_LEVEL", "INFO"))
     args = parser.parse_args()
 
@@ -160,9 +320,9 @@ def main() -> None:
         sys.exit(2)
 
     if args.multi:
-        run_ffmpeg_multibitrate(input_path, output_dir, args.ffmpeg_bin, args.segment_time)
+        run_ffmpeg_multibitrate(input_path, output_dir, args.ffmpeg_bin, args.segment_time, threads=args.threads)
     else:
-        run_ffmpeg_single(input_path, output_dir, args.ffmpeg_bin, args.segment_time)
+        run_ffmpeg_single(input_path, output_dir, args.ffmpeg_bin, args.segment_time, threads=args.threads)
 
 
 if __name__ == "__main__":
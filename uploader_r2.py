@@ -1,28 +1,37 @@
 #!/usr/bin/env python3
 import argparse
 import logging
-import mimetypes
 import os
 import sys
 from pathlib import Path
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.config import Config
 from dotenv import load_dotenv
+from s3transfer.manager import TransferManager
 
 
+MULTIPART_SIZE = 16 * 1024 * 1024
+# Roughly one .ts segment per read instead of boto3's default 256 KB reads.
+IO_CHUNK_SIZE = 8 * 1024 * 1024
+
 HLS_TYPES = {
     ".m3u8": "application/vnd.apple.mpegurl",
     ".ts": "video/MP2T",
 }
 
 
+HLS_CACHE_CONTROL = {
+    # Segments never change once written; playlists get a short TTL to be safe.
+    ".ts": "public, max-age=31536000, immutable",
+    ".m3u8": "public, max-age=60",
+}
+
+
 def guess_content_type(path: Path) -> str:
-    ext = path.suffix.lower()
-    if ext in HLS_TYPES:
-        return HLS_TYPES[ext]
-    ctype, _ = mimetypes.guess_type(str(path))
-    return ctype or "application/octet-stream"
+    # HLS output only ever contains playlists and segments, so skip the mimetypes database.
+    return HLS_TYPES.get(path.suffix.lower(), "application/octet-stream")
 
 
 def get_env(name: str) -> str:
@@ -32,13 +41,23 @@ def get_env(name: str) -> str:
     return v
 
 
+def upload_concurrency() -> int:
+    # Read at call time so values loaded by load_dotenv() after import still apply.
+    return int(os.getenv("R2_UPLOAD_CONCURRENCY", "16"))
+
+
 def make_s3_client():
     account_id = get_env("R2_ACCOUNT_ID")
     access_key = get_env("R2_ACCESS_KEY_ID")
     secret_key = get_env("R2_SECRET_ACCESS_KEY")
     endpoint_url = f"https://{account_id}.r2.cloudflarestorage.com"
-    cfg = Config(signature_version="s3v4", retries={"max_attempts": 10, "mode": "standard"})
-    return boto3.client(
+    # Pool must be at least as large as the transfer concurrency or threads queue on connections.
+    cfg = Config(
+        signature_version="s3v4",
+        retries={"max_attempts": 10, "mode": "adaptive"},
+        max_pool_connections=max(32, upload_concurrency()),
+    )
+    return boto3.session.Session().client(
         "s3",
         endpoint_url=endpoint_url,
         aws_access_key_id=access_key,
@@ -48,22 +67,66 @@ def make_s3_client():
     )
 
 
-def upload_folder(folder: Path, key_prefix: str, bucket: str, dry_run: bool = False) -> None:
-    s3 = make_s3_client()
-    folder = folder.resolve()
-    for root, _, files in os.walk(folder):
-        for fname in files:
-            fpath = Path(root) / fname
-            rel = fpath.relative_to(folder)
-            key = f"{key_prefix.rstrip('/')}/{rel.as_posix()}"
-            ctype = guess_content_type(fpath)
-            if dry_run:
-                logging.info("[DRY-RUN] Would upload %s to s3://%s/%s (%s)", fpath, bucket, key, ctype)
-                continue
-            extra = {"ContentType": ctype}
+def make_transfer_config() -> TransferConfig:
+    return TransferConfig(
+        max_concurrency=upload_concurrency(),
+        multipart_threshold=MULTIPART_SIZE,
+        multipart_chunksize=MULTIPART_SIZE,
+        io_chunksize=IO_CHUNK_SIZE,
+        use_threads=True,
+    )
+
+
+def make_transfer_manager(s3=None) -> TransferManager:
+    """One manager bounds total upload concurrency; share it when several folders upload at once."""
+    return TransferManager(s3 or make_s3_client(), make_transfer_config())
+
+
+def _upload_batches(manager: TransferManager, folder: Path, bucket: str, files: list) -> None:
+    # Segments first, then variant playlists, then the master, so no playlist is visible before what it references.
+    segments = [f for f in files if f[0].suffix.lower() != ".m3u8"]
+    variants = [f for f in files if f[0].suffix.lower() == ".m3u8" and f[0].parent != folder]
+    masters = [f for f in files if f[0].suffix.lower() == ".m3u8" and f[0].parent == folder]
+    for batch in (segments, variants, masters):
+        # Submit a whole batch up-front so files upload in parallel; large files go multipart.
+        futures = []
+        for fpath, key, ctype in batch:
             logging.info("Uploading %s -> s3://%s/%s", fpath, bucket, key)
-            s3.upload_file(str(fpath), bucket, key, ExtraArgs=extra)
-    logging.info("Upload complete for folder %s", folder)
+            extra = {"ContentType": ctype}
+            cache_control = HLS_CACHE_CONTROL.get(fpath.suffix.lower())
+            if cache_control:
+                extra["CacheControl"] = cache_control
+            futures.append(manager.upload(str(fpath), bucket, key, extra_args=extra))
+        try:
+            for fut in futures:
+                fut.result()
+        except BaseException:
+            # The manager is shared and outlives this call; stop the rest of the batch so a retry doesn't race it.
+            for fut in futures:
+                fut.cancel()
+            raise
+
+
+def upload_folder(folder: Path, key_prefix: str, bucket: str, dry_run: bool = False, s3=None, manager: TransferManager | None = None) -> None:
+    folder = folder.resolve()
+    prefix = key_prefix.rstrip("/")
+    files = [
+        (fpath, f"{prefix}/{fpath.relative_to(folder).as_posix()}", guess_content_type(fpath))
+        for fpath in folder.rglob("*")
+        if fpath.is_file()
+    ]
+
+    if dry_run:
+        for fpath, key, ctype in files:
+            logging.info("[DRY-RUN] Would upload %s to s3://%s/%s (%s)", fpath, bucket, key, ctype)
+        return
+
+    if manager is None:
+        with make_transfer_manager(s3) as own_manager:
+            _upload_batches(own_manager, folder, bucket, files)
+    else:
+        _upload_batches(manager, folder, bucket, files)
+    logging.info("Upload complete for folder %s (%d files)", folder, len(files))
 
 
 def main() -> None: